@@ -2,10 +2,17 @@ from typing import Union, List
 
 from dependency import User, user_collection, image_collection, PAGINATION_PAGE_SIZE, UniversalMLImage, Roles, \
     APIKeyData, \
-    api_key_collection, model_collection, TrainingResult, training_collection, logger
+    api_key_collection, model_collection, TrainingResult, training_collection, logger, redis, MODEL_CACHE_TTL, \
+    IMAGE_COUNT_CACHE_TTL
+from pymongo import UpdateOne
+from redis.exceptions import RedisError
+import hashlib
 import math
 import json
 
+MODEL_CACHE_KEY = 'models:all'
+IMAGE_VERSION_KEY = 'images:version'
+
 
 # ---------------------------
 # User Database Interactions
@@ -141,6 +148,33 @@ def add_image_db(image: UniversalMLImage):
         image_collection.insert_one(image.dict())
 
 
+def add_uploaded_images_db(images: List[UniversalMLImage]):
+    """
+    Adds a batch of uploaded images to the database in a single bulk write. Images that do not exist yet are
+    inserted, and images that already exist have the users and file names of the upload added to them.
+
+    :param images: UniversalMLImage for each uploaded image, containing the uploading user and file name.
+    """
+    if not images:
+        return
+
+    image_collection.bulk_write([
+        UpdateOne(
+            {'hash_md5': image.hash_md5},
+            {
+                '$setOnInsert': image.dict(exclude={'users', 'file_names'}),
+                '$addToSet': {
+                    'users': {'$each': image.users},
+                    'file_names': {'$each': image.file_names}
+                }
+            },
+            upsert=True
+        )
+        for image in images
+    ], ordered=False)
+    invalidate_image_counts()
+
+
 def add_user_to_image(image: UniversalMLImage, username: str):
     """
     Adds a user account to a UniversalMLImage record. This is used to track which users upload images.
@@ -192,6 +226,7 @@ def add_model_to_image_db(image: UniversalMLImage, model_name, result):
         'models.' + model_name: result,
         'metadata': json.dumps(new_metadata)
     }})
+    invalidate_image_counts()  # Model results and metadata change which searches the image matches
 
 
 def get_images_from_user_db(
@@ -237,12 +272,13 @@ def get_images_from_user_db(
         if Roles.admin.name not in user.roles:  # Add username to limit results if not admin
             search_params.append({'users': username})
 
-        result = image_collection.find({'$and': search_params}, {"hash_md5"})
+        query = {'$and': search_params}
     else:
         if Roles.admin.name in user.roles:
-            result = image_collection.find({}, {"hash_md5"})
+            query = {}
         else:
-            result = image_collection.find({'users': username}, {"hash_md5"})
+            query = {'users': username}
+    result = image_collection.find(query, {"hash_md5"})
 
     # If we are getting a specific page of images, then generate the list of hashes
     final_hash_list = []
@@ -256,7 +292,16 @@ def get_images_from_user_db(
     elif not paginate:  # Return all results
         final_hash_list = [image_map['hash_md5'] for image_map in list(result)]
 
-    num_images = result.count()
+    # Counting every matching image is repeated for each page of the same search, so the count is cached
+    # for a short time. When all results are returned, they are counted directly instead.
+    if paginate:
+        count_cache_key = get_image_count_cache_key(query)
+        num_images = get_cached_value(count_cache_key)
+        if num_images is None:
+            num_images = image_collection.count_documents(query)
+            set_cached_value(count_cache_key, num_images, IMAGE_COUNT_CACHE_TTL)
+    else:
+        num_images = len(final_hash_list)
     return_value = {
         "hashes": final_hash_list,
         "num_images": num_images
@@ -307,6 +352,20 @@ def get_image_by_md5_hash_db(image_hash) -> Union[UniversalMLImage, None]:
     return UniversalMLImage(**result)
 
 
+def get_images_by_md5_hashes_db(image_hashes: List[str]) -> dict:
+    """
+    Locates the data of several images by their md5 hashes with a single query. The data is returned as stored in
+    the database rather than as UniversalMLImage objects, for callers that only return it to a client.
+
+    :param image_hashes: md5 hashes of images to search for
+    :return: Dictionary of {md5 hash: image data} for each image found
+    """
+    return {
+        image['hash_md5']: image
+        for image in image_collection.find({'hash_md5': {'$in': image_hashes}}, {'_id': 0})
+    }
+
+
 # ---------------------------
 # Model Database Interactions
 # ---------------------------
@@ -325,6 +384,7 @@ def add_model_db(model_name: str, model_fields: List[str]):
             'model_name': model_name,
             'model_fields': model_fields
         })
+        delete_cached_value(MODEL_CACHE_KEY)  # Cached model list no longer contains every model
 
 
 def get_models_db():
@@ -334,11 +394,88 @@ def get_models_db():
 
     :return: List of all models and their classes. [] if no models registered.
     """
+    cached_model_list = get_cached_value(MODEL_CACHE_KEY)
+    if cached_model_list is not None:
+        return cached_model_list
+
     all_models = list(model_collection.find())
     model_list = {model['model_name']: model['model_fields'] for model in all_models}
+    set_cached_value(MODEL_CACHE_KEY, model_list, MODEL_CACHE_TTL)
     return model_list
 
 
+# ---------------------------
+# Cache Interactions
+# ---------------------------
+
+
+def get_image_count_cache_key(query: dict) -> str:
+    """
+    Creates the key that the number of images matching a query is cached under. The key includes the current image
+    version, so that counts cached before images were added or updated are no longer used.
+
+    :param query: Mongo query used to find images
+    :return: Cache key for the image count of the query
+    """
+    version = get_cached_value(IMAGE_VERSION_KEY) or 0
+    query_hash = hashlib.blake2b(json.dumps(query, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+    return 'images:count:' + str(version) + ':' + query_hash
+
+
+def invalidate_image_counts():
+    """
+    Increments the image version, so that all cached image counts are no longer used. This must be called whenever
+    images are added or updated in a way that changes which searches they match.
+    """
+    try:
+        redis.incr(IMAGE_VERSION_KEY)
+    except RedisError:
+        logger.debug('Unable to increment cache key: ' + IMAGE_VERSION_KEY)
+
+
+def get_cached_value(key: str):
+    """
+    Gets a JSON value that has been cached in redis. The cache is only an optimization, so if redis is unavailable
+    this behaves as a cache miss.
+
+    :param key: Key value was cached under
+    :return: Cached value, or None if the key is not cached
+    """
+    try:
+        cached_value = redis.get(key)
+    except RedisError:
+        logger.debug('Unable to read cache key: ' + key)
+        return None
+
+    return json.loads(cached_value) if cached_value is not None else None
+
+
+def set_cached_value(key: str, value, ttl: int):
+    """
+    Caches a JSON serializable value in redis for a limited time.
+
+    :param key: Key to cache value under
+    :param value: JSON serializable value
+    :param ttl: Number of seconds before the cached value expires
+    """
+    try:
+        redis.set(key, json.dumps(value), ex=ttl)
+    except RedisError:
+        logger.debug('Unable to write cache key: ' + key)
+
+
+def delete_cached_value(key: str):
+    """
+    Removes a cached value from redis so that the next read goes to the database.
+
+    :param key: Key value was cached under
+    """
+    try:
+        redis.delete(key)
+    except RedisError:
+        logger.debug('Unable to delete cache key: ' + key)
+
+
 # ------------------------------
 # Training Database Interactions
 # ------------------------------
@@ -12,6 +12,10 @@ import os
 
 from rq import Queue
 import redis as rd
+import redis.asyncio as async_rd
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger("api")
 
@@ -33,6 +37,8 @@ training_collection = database[
 ]  # Create collection for training status and results
 
 PAGINATION_PAGE_SIZE = 15
+MODEL_CACHE_TTL = 15  # Seconds that the list of all models seen by the server is cached for
+IMAGE_COUNT_CACHE_TTL = 5  # Seconds that the number of images matching a search is cached for
 
 
 # --------------------------------------------------------------------------------
@@ -53,12 +59,24 @@ settings = Settings()
 
 pool = ThreadPoolExecutor(10)
 WAIT_TIME = 10
+SERVER_PORT = os.getenv("SERVER_PORT", default="5000")  # Port that model workers send prediction results to
+MODEL_FAILED_PING_LIMIT = 3  # Consecutive failed health checks before a model is removed
 shutdown = False  # Signal used to shutdown running threads on restart
 
+# Shared HTTP clients for calls to prediction and training microservices. These keep connections alive between
+# requests instead of opening a new connection for every call. The async client is used by request handlers,
+# and the requests session by the background threads that ping datasets.
+http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=64))
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
 # Redis Queue for model-prediction jobs
-redis = rd.Redis(host="redis", port=6379)
+redis = rd.Redis(host=os.getenv("REDIS_HOST", default="redis"), port=6379)
 prediction_queue = Queue("model_prediction", connection=redis)
 
+# Async redis client, used by request handlers that wait on redis for a long time, such as pub/sub subscriptions
+async_redis = async_rd.Redis(host=os.getenv("REDIS_HOST", default="redis"), port=6379)
+
 
 class UniversalMLImage(BaseModel):
     """
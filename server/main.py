@@ -1,21 +1,25 @@
+import asyncio
 import time
 
 from fastapi.logger import logger
 
 import dependency
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette import status
 from starlette.responses import JSONResponse
 
 from dependency import CredentialException, pool
 from routers.auth import auth_router
-from routers.prediction import model_router
+from routers.prediction import model_router, model_health_watchdog
 from routers.training import training_router
 
 
 # App instance used by the server
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+model_health_watchdog_task = None  # Background task started with the server that pings registered models
 
 # --------------------------------------------------------------------------
 #                        | Router Registration |
@@ -112,15 +116,29 @@ async def root():
     }
 
 
+@app.on_event('startup')
+async def on_startup():
+    """
+    On server startup, begin the background task that checks that every registered model is still responsive.
+    """
+    global model_health_watchdog_task
+    model_health_watchdog_task = asyncio.create_task(model_health_watchdog())
+
+
 @app.on_event('shutdown')
-def on_shutdown():
+async def on_shutdown():
     """
-    On server shutdown, stop all background model pinging threads, as well as clear
+    On server shutdown, stop all background model and dataset pinging, as well as clear
     the redis model prediction queue. This is necessary to prevent the workers from
     spawning multiple instances on restart.
     """
 
     dependency.shutdown = True  # Send shutdown signal to threads
+    if model_health_watchdog_task:
+        model_health_watchdog_task.cancel()
     pool.shutdown()  # Clear any non-processed jobs from thread queue
+    await dependency.http_client.aclose()
+    dependency.http_session.close()
+    await dependency.async_redis.aclose()
     dependency.prediction_queue.empty()  # Removes all pending jobs from the queue
 
@@ -1,27 +1,43 @@
+import asyncio
 import hashlib
+import json
 import os
-import shutil
-import time
+import re
+import uuid
 
 from rq.registry import StartedJobRegistry
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse
 
 import dependency
-import requests
-from fastapi import File, UploadFile, HTTPException, Depends, APIRouter
+import httpx
+from fastapi import HTTPException, Depends, APIRouter, Request
+from redis.exceptions import RedisError
+from rq import Queue
 from rq.job import Job
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget
 
 from routers.auth import current_user_investigator
-from dependency import logger, MicroserviceConnection, settings, prediction_queue, redis, User, pool, UniversalMLImage
-from db_connection import add_image_db, add_user_to_image, get_images_from_user_db, get_image_by_md5_hash_db, \
-    get_api_key_by_key_db, add_filename_to_image, add_model_to_image_db, get_models_db, add_model_db
+from dependency import logger, MicroserviceConnection, settings, redis, async_redis, User, UniversalMLImage, \
+    http_client
+from db_connection import add_uploaded_images_db, get_images_from_user_db, get_image_by_md5_hash_db, \
+    get_images_by_md5_hashes_db, get_api_key_by_key_db, add_model_to_image_db, get_models_db, add_model_db
 from typing import (
     List
 )
 
 model_router = APIRouter()
 
+PREDICTION_IMAGE_DIRECTORY = '/app/prediction_images/'  # Storage volume shared with model workers
+MODEL_PREDICTION_FUNCTION = 'src.server.main.predict_image'  # Job function run by prediction microservice workers
+JOB_ID_SEPARATOR = '-'  # Separates image hash and model name in prediction job IDs
+MODEL_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')  # Model names are part of job IDs, which rq restricts to these
+PREDICTION_CHANNEL_PREFIX = 'predictions:'  # Redis channel, followed by image hash, that finished models publish to
+
 
 @model_router.get("/list", dependencies=[Depends(current_user_investigator)])
 async def get_available_prediction_models():
@@ -42,98 +58,212 @@ async def get_all_prediction_models():
 
 
 @model_router.post("/predict")
-def create_new_prediction_on_image(images: List[UploadFile] = File(...),
-                                   models: List[str] = (),
-                                   current_user: User = Depends(current_user_investigator)):
+async def create_new_prediction_on_image(request: Request, current_user: User = Depends(current_user_investigator)):
     """
     Create a new prediction request for any number of images on any number of models. This will enqueue the jobs
     and a worker will process them and get the results. Once this is complete, a user may later query the job
     status by the unique key that is returned from this method for each image uploaded.
 
+    The request body is multipart/form-data containing any number of 'images' files and 'models' fields. It is
+    parsed as it streams in, so every image is hashed and written to the prediction volume without first being
+    buffered in a temporary upload file.
+
+    :param request: HTTP Request object with images and models in its multipart/form-data body
     :param current_user: User object who is logged in
-    :param images: List of file objects that will be used by the models for prediction
-    :param models: List of models to run on images
     :return: Unique keys for each image uploaded in images.
     """
 
+    # Hash each uploaded image while writing it to the prediction volume
+    image_target = PredictionImageTarget()
+    model_target = FormValuesTarget()
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('images', image_target)
+        parser.register('models', model_target)
+        async for chunk in request.stream():
+            await run_in_threadpool(parser.data_received, chunk)
+
+        # The parser does not fail when a body ends without its closing boundary, so check that no part was cut off
+        if image_target.unfinished or model_target.unfinished:
+            raise ParseFailedException('Multipart body ended before its last part finished')
+    except ParseFailedException:
+        image_target.discard()
+        return HTTPException(status_code=400, detail="Unable to parse uploaded images")
+    except Exception:
+        image_target.discard()
+        raise
+
     # Start with error checking on the models list.
     # Ensure that all desired models are valid.
+    models = model_target.values
     if not models:
+        image_target.discard()
         return HTTPException(status_code=400, detail="You must specify models to process images with")
 
-    invalid_models = []
-    for model in models:
-        if model not in settings.available_models:
-            invalid_models.append(model)
+    # Take one snapshot of the available models, so that models registering or being removed
+    # while this request is processed cannot change the result part way through
+    available_models = set(settings.available_models)
+    requested_models = list(dict.fromkeys(models))  # Remove duplicate models while keeping their order
+    invalid_models = [model for model in requested_models if model not in available_models]
 
     if invalid_models:
+        image_target.discard()
         error_message = "Invalid Models Specified: " + ''.join(invalid_models)
         return HTTPException(status_code=400, detail=error_message)
 
-    # Now we must hash each uploaded image
-    # After hashing, we will store the image file on the server.
-
-    buffer_size = 65536  # Read image data in 64KB Chunks for hashlib
-    hashes_md5 = {}
-
-    # Process uploaded images
-    for upload_file in images:
-        file = upload_file.file
-        md5 = hashlib.md5()
-        while True:
-            data = file.read(buffer_size)
-            if not data:
-                break
-            md5.update(data)
-
-        # Process image
-        hash_md5 = md5.hexdigest()
-        hashes_md5[upload_file.filename] = hash_md5
-
-        file.seek(0)
-
-        if get_image_by_md5_hash_db(hash_md5):
-            image_object = get_image_by_md5_hash_db(hash_md5)
-        else:  # If image does not already exist in db
-
-            # Create a UniversalMLImage object to store data
-            image_object = UniversalMLImage(**{
-                'file_names': [upload_file.filename],
-                'hash_md5': hash_md5,
-                'hash_sha1': 'TODO: Remove This Field',
-                'hash_perceptual': 'TODO: Remove This Field',
-                'users': [current_user.username],
-                'models': {}
-            })
+    if not image_target.images:
+        return HTTPException(status_code=400, detail="You must specify images to process")
 
-            # Add created image object to database
-            add_image_db(image_object)
+    # Now that the request is valid, store the images and then record them in the database, so that no image is
+    # recorded without its file. Their prediction jobs are enqueued last, since workers post results for images that
+    # must already be recorded. This way the images are pending as soon as this request returns. Database and file
+    # access is run in the threadpool to keep the event loop free.
+    # Every field is generated by the server, so the image objects are constructed without validation.
+    hashes_md5 = {filename: hash_md5 for filename, hash_md5, _ in image_target.images}
+    try:
+        stored_images = await run_in_threadpool(store_uploaded_images, image_target.images)
+        await run_in_threadpool(add_uploaded_images_db, [
+            UniversalMLImage.construct(
+                file_names=[filename],
+                hash_md5=hash_md5,
+                hash_sha1='TODO: Remove This Field',
+                hash_perceptual='TODO: Remove This Field',
+                users=[current_user.username],
+                models={}
+            )
+            for filename, hash_md5, _ in image_target.images
+        ])
+    except Exception:
+        image_target.discard()
+        raise
+
+    # Enqueue every (image, model) prediction job directly onto the model queues
+    for hash_md5, _ in stored_images:
+        logger.debug('Creating Prediction Request. Hash: ' + hash_md5 + ' Models: ' + ', '.join(requested_models))
+    try:
+        await run_in_threadpool(enqueue_prediction_jobs, stored_images, requested_models)
+    except RedisError:
+        logger.error('Fatal error when creating prediction requests. Hashes: ' + ', '.join(hashes_md5.values()))
 
-        # Associate the current user with the image that was uploaded
-        add_user_to_image(image_object, current_user.username)
+    return {"images": list(hashes_md5.values())}
 
-        # Associate the name the file was uploaded under to the object
-        add_filename_to_image(image_object, upload_file.filename)
 
-        # Copy image to the temporary storage volume for prediction
-        new_filename = hash_md5 + os.path.splitext(upload_file.filename)[1]
-        stored_image_path = "/app/prediction_images/" + new_filename
-        stored_image = open(stored_image_path, 'wb+')
-        shutil.copyfileobj(file, stored_image)
+def enqueue_prediction_jobs(stored_images: List[tuple], models: List[str]):
+    """
+    Enqueues a prediction job for every (image, model) pair directly onto the redis queue of each model, which is
+    named after the model and processed by that model's workers. Every job is enqueued in a single redis pipeline.
+    Job IDs are a composite of image hash and model name, in the format of <hash>-<model>.
 
+    :param stored_images: (md5 hash, stored file name) of each image to predict on
+    :param models: Names of models to run on each image
+    """
+    # The same image may be uploaded more than once in a request, but is only predicted on once by each model
+    stored_images = list(dict(stored_images).items())
+
+    with redis.pipeline() as pipe:
         for model in models:
-            model_socket = settings.available_models[model]
-            try:
-                logger.debug('Creating Prediction Request. Hash: ' + hash_md5 + ' Model: ' + model)
-                request = requests.post(
-                    model_socket + '/predict',
-                    params={'image_md5_hash': hash_md5, 'image_file_name': new_filename}
+            Queue(model, connection=redis).enqueue_many([
+                Queue.prepare_data(
+                    MODEL_PREDICTION_FUNCTION,
+                    args=(hash_md5, new_filename, dependency.SERVER_PORT, model),
+                    job_id=hash_md5 + JOB_ID_SEPARATOR + model
                 )
-                request.raise_for_status()  # Ensure prediction job hasn't errored.
-            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
-                logger.error('Fatal error when creating prediction request. Hash: "' + hash_md5 + '" Model: ' + model)
+                for hash_md5, new_filename in stored_images
+            ], pipeline=pipe)
+        pipe.execute()
+
+
+class PredictionImageTarget(BaseTarget):
+    """
+    Multipart target that hashes every uploaded image while writing it to the prediction volume, so each byte
+    received from the client is only handled once. Images are written under a temporary name, since the name they
+    are stored under depends on their hash.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.images = []  # (file name, md5 hash, temporary path) of every image received
+        self._md5 = None
+        self._file = None
+
+    def on_start(self):
+        self._md5 = hashlib.md5()
+        self._file = open(PREDICTION_IMAGE_DIRECTORY + '.' + uuid.uuid4().hex + '.part', 'wb')
+
+    def on_data_received(self, chunk: bytes):
+        self._md5.update(chunk)
+        self._file.write(chunk)
+
+    def on_finish(self):
+        self._file.close()
+        self.images.append((self.multipart_filename or '', self._md5.hexdigest(), self._file.name))
+        self._file = None
+
+    @property
+    def unfinished(self) -> bool:
+        """
+        Whether an image has been started but not finished, which happens when the body is cut off part way through
+        """
+        return self._file is not None
+
+    def discard(self):
+        """
+        Removes every temporary image written by this target. Used when a request fails before all of its images
+        are stored.
+        """
+        if self._file:
+            self._file.close()
+            os.remove(self._file.name)
+            self._file = None
+        for _, _, temporary_image_path in self.images:
+            try:
+                os.remove(temporary_image_path)
+            except FileNotFoundError:
+                pass  # Image has already been moved to its final name
+        self.images = []
 
-    return {"images": [hashes_md5[key] for key in hashes_md5]}
+
+class FormValuesTarget(BaseTarget):
+    """
+    Multipart target that collects every value sent for a form field that may be repeated.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.values = []
+        self._chunks = None
+
+    def on_start(self):
+        self._chunks = []
+
+    def on_data_received(self, chunk: bytes):
+        self._chunks.append(chunk)
+
+    def on_finish(self):
+        self.values.append(b''.join(self._chunks).decode('utf-8'))
+        self._chunks = None
+
+    @property
+    def unfinished(self) -> bool:
+        """
+        Whether a value has been started but not finished, which happens when the body is cut off part way through
+        """
+        return self._chunks is not None
+
+
+def store_uploaded_images(uploaded_images: List[tuple]) -> List[tuple]:
+    """
+    Moves uploaded images to their final names on the prediction volume so that model workers can access them.
+
+    :param uploaded_images: (file name, md5 hash, temporary path) of each image, as collected by PredictionImageTarget
+    :return: (md5 hash, stored file name) of each image
+    """
+    stored_images = []
+    for filename, hash_md5, temporary_image_path in uploaded_images:
+        new_filename = hash_md5 + os.path.splitext(filename)[1]
+        os.replace(temporary_image_path, PREDICTION_IMAGE_DIRECTORY + new_filename)
+        stored_images.append((hash_md5, new_filename))
+    return stored_images
 
 
 @model_router.post("/results", dependencies=[Depends(current_user_investigator)])
@@ -149,27 +279,29 @@ async def get_jobs(md5_hashes: List[str]):
     if not md5_hashes:
         return []
 
+    # We must get all running and pending jobs to return the correct value. Since job_id is a composite
+    # of <hash>-<model>, the hash of every image with an unfinished job can be read from the job IDs.
+    # These do not depend on the requested hashes, so they are fetched once for the whole request.
+    pending_job_ids = await run_in_threadpool(get_pending_job_ids)
+    pending_jobs = await run_in_threadpool(Job.fetch_many, pending_job_ids, connection=redis)
+    pending_hashes = {
+        job.id.split(JOB_ID_SEPARATOR, 1)[0]
+        for job in pending_jobs if job and job.get_status(refresh=False) != 'finished'
+    }
+
+    # Get the data of every requested image with one query, as it is returned without any changes
+    images = await run_in_threadpool(get_images_by_md5_hashes_db, md5_hashes)
+
     for md5_hash in md5_hashes:
+        image = images.get(md5_hash)
 
         # If there are any pending predictions, alert user and return existing ones
-        # Since job_id is a composite hash+model, we must loop and find all jobs that have the
-        # hash we want to find. We must get all running and pending jobs to return the correct value
-        all_jobs = StartedJobRegistry('model_prediction', connection=redis).get_job_ids() + prediction_queue.job_ids
-
-        image = get_image_by_md5_hash_db(md5_hash)  # Get image object
-        found_pending_job = False
-        for job_id in all_jobs:
-            if md5_hash in job_id and Job.fetch(job_id, connection=redis).get_status() != 'finished':
-                found_pending_job = True
-                results.append({
-                    'status': 'success',
-                    'detail': 'Image has pending predictions. Check back later for all model results.',
-                    **image.dict()
-                })
-                break  # Don't look for more jobs since we have found one that is pending
-
-        # If we have found a job that is pending, then move on to next image
-        if found_pending_job:
+        if md5_hash in pending_hashes:
+            results.append({
+                'status': 'success',
+                'detail': 'Image has pending predictions. Check back later for all model results.',
+                **image
+            })
             continue
 
         # If we haven't found a pending job for this image, and it doesn't exist in our database, then that
@@ -185,9 +317,61 @@ async def get_jobs(md5_hashes: List[str]):
         # If everything is successful with image, return data
         results.append({
             'status': 'success',
-            **image.dict()
+            **image
         })
-    return results
+
+    # The results are raw database documents, so they are encoded directly instead of being validated again
+    return ORJSONResponse(results)
+
+
+def get_pending_job_ids():
+    """
+    Gets the IDs of every running and queued prediction job on the queues of all available models. The job IDs of
+    every queue are read in a single redis pipeline.
+
+    :return: List of pending job IDs
+    """
+    with redis.pipeline() as pipe:
+        for model in list(settings.available_models):
+            pipe.zrange(StartedJobRegistry(model, connection=redis).key, 0, -1)
+            pipe.lrange(Queue(model, connection=redis).key, 0, -1)
+        job_id_lists = pipe.execute()
+
+    # Newer versions of rq store running jobs in the registry as <job_id>:<execution_id>
+    return [job_id.decode().split(':', 1)[0] for job_ids in job_id_lists for job_id in job_ids]
+
+
+@model_router.get("/results/stream/{md5_hash}", dependencies=[Depends(current_user_investigator)])
+async def stream_prediction_results(md5_hash: str, request: Request):
+    """
+    Streams an event each time a model finishes predicting on an image, using server-sent events. Clients may use
+    this instead of repeatedly polling /results, and request the full results once the models they are waiting
+    on have finished.
+
+    The stream starts with a comment once the subscription is active, so a client may request /results after
+    receiving it without missing any predictions that finish in between.
+
+    :param md5_hash: md5 hash of image to receive prediction events for
+    :param request: HTTP Request object, used to stop streaming once the client disconnects
+    :return: text/event-stream with {'hash_md5': ..., 'model_name': ...} for each finished prediction.
+    """
+
+    async def prediction_events():
+        # Subscribe only once the response is streaming, so that no subscription is left open if it never starts.
+        # Messages are awaited on the event loop, so open streams do not hold threadpool workers.
+        pubsub = async_redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(PREDICTION_CHANNEL_PREFIX + md5_hash)
+            yield ': subscribed\n\n'
+            while not await request.is_disconnected():
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message:
+                    event = {'hash_md5': md5_hash, 'model_name': message['data'].decode()}
+                    yield 'data: ' + json.dumps(event) + '\n\n'
+        finally:
+            await pubsub.aclose()
+
+    return StreamingResponse(prediction_events(), media_type='text/event-stream')
 
 
 @model_router.post("/search")
@@ -303,10 +487,10 @@ def get_api_key(api_key_header: str = Depends(dependency.api_key_header_auth)):
 
 
 @model_router.post("/register", dependencies=[Depends(get_api_key)])
-def register_model(model: MicroserviceConnection):
+async def register_model(model: MicroserviceConnection):
     """
     Register a single model to the server by adding the model's name and socket
-    to available model settings. Also kick start a separate thread to keep track
+    to available model settings. The model health watchdog will then keep track
     of the model service status. Models that are registered must use a valid API key.
 
     :param model: MicroserviceConnection object with the model name and model socket.
@@ -323,6 +507,14 @@ def register_model(model: MicroserviceConnection):
             }
         )
 
+    # Model names are used in prediction job IDs, so they may only contain characters that rq allows in job IDs
+    if not MODEL_NAME_PATTERN.fullmatch(model.name):
+        return {
+            "status": "failure",
+            'model': model.name,
+            'detail': 'Model name may only contain letters, numbers, underscores and dashes.'
+        }
+
     # Do not add duplicates of running models to server
     if model.name in settings.available_models:
         return {
@@ -333,18 +525,17 @@ def register_model(model: MicroserviceConnection):
 
     # Ensure that we can connect back to model before adding it
     try:
-        r = requests.get(model.socket + '/status')
+        r = await http_client.get(model.socket + '/status')
         r.raise_for_status()
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
+    except httpx.HTTPError:
         return {
             "status": "failure",
             'model': model.name,
             'detail': 'Unable to establish successful connection to model.'
         }
 
-    # Register model to server and create thread to ensure model is responsive
+    # Register model to server. The health watchdog will begin checking that it is responsive.
     settings.available_models[model.name] = model.socket
-    pool.submit(ping_model, model.name)
 
     logger.debug("Model " + model.name + " successfully registered to server.")
 
@@ -374,33 +565,62 @@ def receive_prediction_results(model_prediction_result: dependency.ModelPredicti
         add_model_to_image_db(image_object, model_prediction_result.model_name, model_result)
         add_model_db(model_prediction_result.model_name, model_classes)
 
+        # Notify clients streaming the results of this image that the model has finished
+        try:
+            redis.publish(PREDICTION_CHANNEL_PREFIX + model_prediction_result.image_hash,
+                          model_prediction_result.model_name)
+        except RedisError:
+            logger.error('Unable to publish prediction result. Hash: "' + model_prediction_result.image_hash +
+                         '" Model: ' + model_prediction_result.model_name)
 
-def ping_model(model_name):
-    """
-    Periodically ping a model's service to make sure that it is active. If it's not, remove the model from the
-    available_models BaseSetting in dependency.py
 
-    :param model_name: Name of model to ping. This is the name the model registered to the server with.
+async def model_health_watchdog():
+    """
+    Periodically ping every registered model's service to make sure that it is active. All models are pinged
+    concurrently by this single task, which is started with the server. A model that fails
+    MODEL_FAILED_PING_LIMIT pings in a row is removed from the available_models BaseSetting in dependency.py
     """
 
-    model_is_alive = True
-
-    def kill_model():
-        settings.available_models.pop(model_name)
-        nonlocal model_is_alive
-        model_is_alive = False
-        logger.debug("Model " + model_name + " is not responsive. Removing the model from available services...")
+    failed_pings = {}  # Number of consecutive failed pings for each model
 
-    while model_is_alive and not dependency.shutdown:
+    while not dependency.shutdown:
+        # This task checks the health of every model, so an unexpected error must not stop it
         try:
-            r = requests.get('http://host.docker.internal:' + str(settings.available_models[model_name]) + '/status')
-            r.raise_for_status()
-            for increment in range(dependency.WAIT_TIME):
-                if not dependency.shutdown:  # Check between increments to stop hanging on shutdown
-                    time.sleep(1)
-        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
-            kill_model()
-            return
+            await ping_models(failed_pings)
+        except Exception:
+            logger.exception('Unable to check the health of registered models')
 
-    if dependency.shutdown:
-        logger.debug("Model [" + model_name + "] Healthcheck Thread Terminated.")
+        await asyncio.sleep(dependency.WAIT_TIME)
+
+
+async def ping_models(failed_pings: dict):
+    """
+    Pings every registered model's service once, and removes models that have failed MODEL_FAILED_PING_LIMIT
+    pings in a row.
+
+    :param failed_pings: Number of consecutive failed pings for each model, updated with the results of these pings
+    """
+    models = dict(settings.available_models)
+    responses = await asyncio.gather(*[
+        http_client.get(model_socket + '/status', timeout=dependency.WAIT_TIME) for model_socket in models.values()
+    ], return_exceptions=True)
+
+    for (model_name, model_socket), response in zip(models.items(), responses):
+        # Any error from a ping counts as a failed ping for that model, so one model cannot stop the others
+        # from being checked
+        try:
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+            failed_pings.pop(model_name, None)
+        except Exception:
+            failed_pings[model_name] = failed_pings.get(model_name, 0) + 1
+            if failed_pings[model_name] < dependency.MODEL_FAILED_PING_LIMIT:
+                continue
+
+            # Only remove the model if it has not re-registered with a new socket in the meantime
+            if settings.available_models.get(model_name) == model_socket:
+                settings.available_models.pop(model_name)
+                logger.debug("Model " + model_name + " is not responsive. Removing the model from available "
+                             "services...")
+            failed_pings.pop(model_name)
@@ -2,19 +2,23 @@ import os
 import shutil
 import time
 
+import httpx
 import requests
 from fastapi import Depends, APIRouter, UploadFile, File
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import JSONResponse, FileResponse
 
 import dependency
 from db_connection import get_api_key_by_key_db, update_training_result_db, get_training_result_by_training_id, \
     add_training_result_db, get_training_statistics_db, get_bulk_training_results_reverse_order_db
-from dependency import logger, MicroserviceConnection, settings, pool, APIKeyData
+from dependency import logger, MicroserviceConnection, settings, pool, APIKeyData, http_client, http_session
 from routers.auth import current_user_researcher, current_user_admin
 
 training_router = APIRouter()
 
+UPLOAD_BUFFER_SIZE = 1 << 20  # Copy uploaded files in 1MB chunks
+
 
 @training_router.get("/list", dependencies=[Depends(current_user_researcher)])
 async def get_available_training_datasets():
@@ -70,7 +74,7 @@ async def send_training_request(training_data: dependency.TrainingRequestHttpBod
         }
 
     try:
-        r = requests.post(
+        r = await http_client.post(
             settings.available_datasets[training_data.dataset] + '/train',
             json={
                 'model_structure': training_data.model_structure,
@@ -95,7 +99,7 @@ async def send_training_request(training_data: dependency.TrainingRequestHttpBod
 
         add_training_result_db(training_result)
 
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
+    except httpx.HTTPError:
         return {
             'status': 'failure',
             'detail': 'Unable to establish connection with dataset server.'
@@ -282,9 +286,8 @@ async def save_model_to_disk(training_id: str = '', model: UploadFile = File(...
             'training_id': training_id
         }
 
-    upload_folder = open(os.path.join('/app/training_results', model.filename), 'wb+')
-    shutil.copyfileobj(model.file, upload_folder)
-    upload_folder.close()
+    with open(os.path.join('/app/training_results', model.filename), 'wb+') as upload_folder:
+        await run_in_threadpool(shutil.copyfileobj, model.file, upload_folder, UPLOAD_BUFFER_SIZE)
     return {
         'status': 'success',
         'detail': 'Training results uploaded successfully',
@@ -293,7 +296,7 @@ async def save_model_to_disk(training_id: str = '', model: UploadFile = File(...
 
 
 @training_router.post("/register", dependencies=[Depends(get_api_key)])
-def register_dataset(dataset: MicroserviceConnection):
+async def register_dataset(dataset: MicroserviceConnection):
     """
     Register a single dataset to the server by adding the name and port
     to available dataset settings. Also kick start a separate thread to keep track
@@ -323,9 +326,9 @@ def register_dataset(dataset: MicroserviceConnection):
 
     # Ensure that we can connect back to dataset before adding it
     try:
-        r = requests.get(dataset.socket + '/status')
+        r = await http_client.get(dataset.socket + '/status')
         r.raise_for_status()
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
+    except httpx.HTTPError:
         return {
             "status": "failure",
             'dataset': dataset.name,
@@ -363,7 +366,7 @@ def ping_dataset(dataset_name):
 
     while dataset_is_alive and not dependency.shutdown:
         try:
-            r = requests.get(
+            r = http_session.get(
                 settings.available_datasets[dataset_name] + '/status')
             r.raise_for_status()
             for increment in range(dependency.WAIT_TIME):
@@ -7,6 +7,13 @@ from db_connection import get_user_by_name_db
 
 from main import app
 
+import hashlib
+import os
+from rq import Queue
+from db_connection import add_uploaded_images_db
+from dependency import image_collection, UniversalMLImage, settings, redis
+from routers import prediction
+
 client = TestClient(app)
 
 # --------------
@@ -24,8 +31,160 @@ def test_register_model():
     # Predict on images
     register_model = client.post("/model/register", json=mlmicroservice_object)
     assert register_model.status_code == 200
-    
-    
+
+
+@pytest.mark.timeout(5)
+def test_register_model_invalid_name():
+    mlmicroservice_object = {"name": "testing.register", "socket": "http://host.docker.internal:5005"}
+
+    register_model = client.post("/model/register", json=mlmicroservice_object)
+    assert register_model.status_code == 200
+    assert register_model.json()['status'] == 'failure'
+    assert register_model.json()['detail'] == 'Model name may only contain letters, numbers, underscores and dashes.'
+
+
+@pytest.mark.timeout(5)
+def test_add_uploaded_images_db():
+
+    def uploaded_image(file_name, username):
+        return UniversalMLImage(file_names=[file_name], hash_md5='testing_bulk_hash', hash_sha1='',
+                                hash_perceptual='', users=[username])
+
+    # Uploading an image that already exists only adds the new user and file name to it
+    add_uploaded_images_db([uploaded_image('a.jpg', 'testing')])
+    add_uploaded_images_db([uploaded_image('b.jpg', 'testing_2'), uploaded_image('a.jpg', 'testing')])
+
+    images = list(image_collection.find({'hash_md5': 'testing_bulk_hash'}))
+    image_collection.delete_many({'hash_md5': 'testing_bulk_hash'})
+
+    assert len(images) == 1
+    assert images[0]['users'] == ['testing', 'testing_2']
+    assert images[0]['file_names'] == ['a.jpg', 'b.jpg']
+    assert images[0]['models'] == {}
+
+
+@pytest.fixture
+def prediction_image_directory(tmp_path, monkeypatch):
+    """
+    Stores uploaded prediction images in a temporary directory instead of the prediction volume.
+    """
+    monkeypatch.setattr(prediction, 'PREDICTION_IMAGE_DIRECTORY', str(tmp_path) + '/')
+    return tmp_path
+
+
+@pytest.fixture
+def prediction_model(monkeypatch):
+    """
+    Registers a model for the duration of a test, and removes every job enqueued on its redis queue afterwards.
+    """
+    model_name = 'testing_prediction_model'
+    monkeypatch.setitem(settings.available_models, model_name, 'http://testing_prediction_model:5000')
+    yield model_name
+    Queue(model_name, connection=redis).delete(delete_jobs=True)
+
+
+@pytest.mark.timeout(5)
+def test_predict_images(prediction_image_directory, prediction_model):
+    first_hash = hashlib.md5(b'testing_first_image').hexdigest()
+    second_hash = hashlib.md5(b'testing_second_image').hexdigest()
+
+    # Repeated models and images are only predicted on once
+    response = client.post("/model/predict", data={'models': [prediction_model, prediction_model]}, files=[
+        ('images', ('first.jpg', b'testing_first_image', 'image/jpeg')),
+        ('images', ('second.png', b'testing_second_image', 'image/png')),
+        ('images', ('first_copy.jpg', b'testing_first_image', 'image/jpeg'))
+    ])
+    image_collection.delete_many({'hash_md5': {'$in': [first_hash, second_hash]}})
+
+    assert response.status_code == 200
+    assert response.json() == {'images': [first_hash, second_hash, first_hash]}
+    assert sorted(os.listdir(prediction_image_directory)) == sorted([first_hash + '.jpg', second_hash + '.png'])
+    assert sorted(Queue(prediction_model, connection=redis).job_ids) == sorted([
+        first_hash + '-' + prediction_model, second_hash + '-' + prediction_model
+    ])
+
+
+@pytest.mark.timeout(5)
+def test_predict_images_invalid_models(prediction_image_directory, prediction_model):
+    image = ('images', ('first.jpg', b'testing_first_image', 'image/jpeg'))
+
+    missing_models = client.post("/model/predict", files=[image])
+    assert missing_models.status_code == 200
+    assert missing_models.json()['status_code'] == 400
+
+    invalid_models = client.post("/model/predict", data={'models': [prediction_model, 'testing_invalid_model']},
+                                 files=[image])
+    assert invalid_models.status_code == 200
+    assert invalid_models.json()['status_code'] == 400
+
+    # Temporary files of uploaded images are removed when the request is rejected
+    assert os.listdir(prediction_image_directory) == []
+    assert Queue(prediction_model, connection=redis).job_ids == []
+
+
+@pytest.mark.timeout(5)
+def test_predict_images_not_multipart(prediction_image_directory, prediction_model):
+    response = client.post("/model/predict", json={'models': [prediction_model]})
+    assert response.status_code == 200
+    assert response.json()['status_code'] == 400
+    assert os.listdir(prediction_image_directory) == []
+
+
+@pytest.mark.timeout(5)
+def test_predict_images_truncated_body(prediction_image_directory, prediction_model):
+    # The second image is cut off before the closing boundary of the body
+    body = (
+        b'--testing_boundary\r\nContent-Disposition: form-data; name="models"\r\n\r\n' +
+        prediction_model.encode() +
+        b'\r\n--testing_boundary\r\nContent-Disposition: form-data; name="images"; filename="first.jpg"\r\n'
+        b'Content-Type: image/jpeg\r\n\r\ntesting_first_image'
+        b'\r\n--testing_boundary\r\nContent-Disposition: form-data; name="images"; filename="second.jpg"\r\n'
+        b'Content-Type: image/jpeg\r\n\r\ntesting_second'
+    )
+    response = client.post("/model/predict", content=body,
+                           headers={'Content-Type': 'multipart/form-data; boundary=testing_boundary'})
+    assert response.status_code == 200
+    assert response.json()['status_code'] == 400
+    assert os.listdir(prediction_image_directory) == []
+    assert Queue(prediction_model, connection=redis).job_ids == []
+
+
+@pytest.mark.timeout(5)
+def test_predict_images_database_failure(prediction_image_directory, prediction_model, monkeypatch):
+    def failing_add_uploaded_images_db(images):
+        raise RuntimeError('testing database failure')
+
+    monkeypatch.setattr(prediction, 'add_uploaded_images_db', failing_add_uploaded_images_db)
+
+    with pytest.raises(RuntimeError):
+        client.post("/model/predict", data={'models': [prediction_model]}, files=[
+            ('images', ('first.jpg', b'testing_first_image', 'image/jpeg'))
+        ])
+
+    # Images are stored before they are recorded. Stored images are kept, since other uploads of the same image
+    # may use them, but no temporary files are left behind and no predictions are enqueued.
+    assert os.listdir(prediction_image_directory) == [hashlib.md5(b'testing_first_image').hexdigest() + '.jpg']
+    assert Queue(prediction_model, connection=redis).job_ids == []
+
+
+@pytest.mark.timeout(5)
+def test_predict_images_storage_failure(prediction_image_directory, prediction_model, monkeypatch):
+    def failing_replace(source, destination):
+        raise OSError('testing storage failure')
+
+    monkeypatch.setattr(prediction.os, 'replace', failing_replace)
+
+    with pytest.raises(OSError):
+        client.post("/model/predict", data={'models': [prediction_model]}, files=[
+            ('images', ('first.jpg', b'testing_first_image', 'image/jpeg'))
+        ])
+
+    # The image is not recorded, since it could not be stored
+    assert image_collection.find_one({'hash_md5': hashlib.md5(b'testing_first_image').hexdigest()}) is None
+    assert os.listdir(prediction_image_directory) == []
+    assert Queue(prediction_model, connection=redis).job_ids == []
+
+
 # --------------
 # Failing Tests
 # --------------